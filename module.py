@@ -2,15 +2,103 @@
 """
 Self-Healing System - Automatic error detection and recovery
 """
+import asyncio
+import httpx
+import ijson
 import requests
 import json
-from datetime import datetime, timedelta
+import orjson
+import os
+import threading
+import time
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from datetime import datetime, timedelta, timezone
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from types import MappingProxyType
+
+AGENT_REPOS: tuple[str, ...] = (
+    'github-arbitrage-agent', 'ai-wrapper-factory', 'saas-template-mill',
+    'automation-broker', 'crypto-degen-bot', 'influencer-farm',
+    'course-generator', 'patent-scraper', 'domain-flipper'
+)
+
+HEALING_STRATEGIES = MappingProxyType({
+    'schedule_failure': {
+        'name': 'Schedule Recovery',
+        'action': 'trigger_manual_run',
+        'success_rate': 85
+    },
+    'execution_failure': {
+        'name': 'Execution Recovery',
+        'action': 'fix_execution_error',
+        'success_rate': 70
+    },
+    'api_error': {
+        'name': 'API Recovery',
+        'action': 'fix_api_issue',
+        'success_rate': 60
+    },
+    'default': {
+        'name': 'Default Recovery',
+        'action': 'apply_default_healing',
+        'success_rate': 50
+    }
+})
+
+# (failure_type, count above which it is a pattern, diagnosis)
+PATTERN_RULES = (
+    ('schedule_failure', 3, 'Multiple schedule failures - check GitHub Actions limits'),
+    ('execution_failure', 2, 'Multiple execution failures - check code quality'),
+)
+
+# Heals are independent, I/O-bound API calls
+MAX_HEAL_WORKERS = 8
+
+# ETags, last-seen runs and workflow IDs survive between scheduled invocations
+HEALTH_CACHE_PATH = '.healing_cache.json'
+
+def _parse_gh_ts(s):
+    """Parse a GitHub 'YYYY-MM-DDTHH:MM:SSZ' timestamp"""
+    return datetime(int(s[0:4]), int(s[5:7]), int(s[8:10]),
+                    int(s[11:13]), int(s[14:16]), int(s[17:19]), tzinfo=timezone.utc)
+
+def _slim_run(run):
+    """Keep only the run fields assess_runs reads - the rest is other repos' metadata"""
+    return {'created_at': run['created_at'], 'conclusion': run.get('conclusion')}
 
 class SelfHealingSystem:
     def __init__(self, github_token):
         self.token = github_token
         self.headers = {'Authorization': f'token {github_token}'}
-        self.healing_strategies = self.load_healing_strategies()
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=20,
+            pool_maxsize=20,
+            max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+        ))
+        self.healing_strategies = HEALING_STRATEGIES
+        self.etag_cache: dict[str, str] = {}
+        self.last_status_cache: dict[str, dict] = {}
+        self._workflow_id_cache: dict[str, int] = {}
+        self._rate_limited_until: float = 0
+        self._rate_limit_failures = 0
+        self._rate_limit_lock = threading.Lock()
+        
+        # Every API URL embeds the username, so fail fast rather than issue doomed requests
+        if self.username is None:
+            raise ValueError("Could not resolve GitHub user - check GITHUB_TOKEN")
+        
+        # Per-repo URL templates, with the owner baked in once
+        repo_url = f"https://api.github.com/repos/{self.username}/{{repo}}"
+        self._runs_url_tpl = f"{repo_url}/actions/runs"
+        self._workflows_url_tpl = f"{repo_url}/actions/workflows"
+        self._dispatch_url_tpl = f"{repo_url}/actions/workflows/{{workflow_id}}/dispatches"
+        
+        self.load_health_cache()
         
     def monitor_and_heal(self):
         """Monitor constellation health and perform healing"""
@@ -23,69 +111,117 @@ class SelfHealingSystem:
         failure_analysis = self.analyze_failures(failed_agents)
         
         # Execute healing strategies
-        healing_results = []
-        for agent in failed_agents:
-            result = self.heal_agent(agent)
-            healing_results.append(result)
+        with ThreadPoolExecutor(max_workers=MAX_HEAL_WORKERS) as executor:
+            healing_results = list(executor.map(self.heal_agent, failed_agents))
         
         # Update healing strategies
         self.update_healing_strategies(failure_analysis)
         
+        self.save_health_cache()
+        
+        healed = sum(1 for r in healing_results if r['success'])
+        
         return {
             'failed_agents': len(failed_agents),
-            'healed_agents': len([r for r in healing_results if r['success']]),
-            'healing_success_rate': len([r for r in healing_results if r['success']]) / max(len(healing_results), 1) * 100
+            'healed_agents': healed,
+            'healing_success_rate': healed / max(len(healing_results), 1) * 100
         }
     
     def detect_failed_agents(self):
         """Detect agents that have failed"""
+        return asyncio.run(self._detect_failed_agents())
+    
+    async def _detect_failed_agents(self):
+        """Check every agent's last run concurrently"""
         failed_agents = []
         
         # Check each agent's last run
-        agent_repos = self.get_all_agent_repos()
-        
-        for repo in agent_repos:
-            status = self.check_agent_health(repo)
-            if not status['healthy']:
-                failed_agents.append({
-                    'repo': repo,
-                    'failure_type': status['failure_type'],
-                    'last_success': status['last_success'],
-                    'error_details': status.get('error_details', 'Unknown')
-                })
+        agent_repos = AGENT_REPOS
+        now = datetime.now(timezone.utc)
+        
+        # HTTP/2 multiplexes every concurrent check over a single connection
+        limits = httpx.Limits(max_connections=20)
+        async with httpx.AsyncClient(http2=True, headers=self.headers, limits=limits) as client:
+            statuses = await self.query_all_agents_health(client, agent_repos, now)
+            
+            # Fall back to per-repo REST checks for anything GraphQL couldn't resolve
+            missing = [repo for repo in agent_repos if repo not in statuses]
+            tasks = [self.check_agent_health(client, repo, now) for repo in missing]
+            statuses.update(zip(missing, await asyncio.gather(*tasks, return_exceptions=True)))
+            
+            for repo in agent_repos:
+                status = statuses[repo]
+                if isinstance(status, BaseException):
+                    status = {
+                        'healthy': False,
+                        'failure_type': 'exception',
+                        'error_details': str(status),
+                        'last_success': None
+                    }
+                # Rate-limited checks are skipped, healing them would only burn more requests
+                if not status['healthy'] and status['failure_type'] != 'rate_limited':
+                    failed_agents.append({
+                        'repo': repo,
+                        'failure_type': status['failure_type'],
+                        'last_success': status['last_success'],
+                        'error_details': status.get('error_details', 'Unknown')
+                    })
+            
+            # Only the latest run was fetched, so look up the last good run just for agents that need it
+            lookups = [agent for agent in failed_agents
+                       if agent['failure_type'] == 'execution_failure' and agent['last_success'] is None]
+            tasks = [self.find_last_successful_run(client, agent['repo']) for agent in lookups]
+            for agent, last_success in zip(lookups, await asyncio.gather(*tasks, return_exceptions=True)):
+                if not isinstance(last_success, BaseException):
+                    agent['last_success'] = last_success
         
         return failed_agents
     
-    def check_agent_health(self, repo):
+    async def check_agent_health(self, client, repo, now):
         """Check health of individual agent"""
         try:
-            url = f"https://api.github.com/repos/{self.get_username()}/{repo}/actions/runs"
-            response = requests.get(url, headers=self.headers)
+            url = self._runs_url_tpl.format(repo=repo)
+            # Only the latest completed run matters; assess_runs judges its age against
+            # now, so the URL carries no time filter and stays stable for the ETag
+            params = {'per_page': 1, 'status': 'completed'}
+            headers = {}
+            if repo in self.etag_cache:
+                headers['If-None-Match'] = self.etag_cache[repo]
             
-            if response.status_code == 200:
-                runs = response.json().get('workflow_runs', [])
-                if runs:
-                    latest_run = runs[0]
-                    
-                    # Check if agent ran recently
-                    last_run_time = datetime.fromisoformat(latest_run['created_at'].replace('Z', '+00:00'))
-                    time_since_run = datetime.now(last_run_time.tzinfo) - last_run_time
-                    
-                    if time_since_run > timedelta(hours=8):  # Should run every 6 hours
-                        return {
-                            'healthy': False,
-                            'failure_type': 'schedule_failure',
-                            'last_success': latest_run['created_at']
-                        }
-                    
-                    if latest_run.get('conclusion') == 'failure':
-                        return {
-                            'healthy': False,
-                            'failure_type': 'execution_failure',
-                            'last_success': self.find_last_successful_run(runs)
-                        }
-                    
-                    return {'healthy': True}
+            data = None
+            rate_limited = self.is_rate_limited()
+            if not rate_limited:
+                async with client.stream('GET', url, params=params, headers=headers) as response:
+                    rate_limited = self.record_rate_limit(response.status_code, response.headers)
+                    if response.status_code == 200:
+                        # Stream just the first run instead of materialising the whole
+                        # payload, in case the server ignores per_page (older GHE)
+                        found = ijson.sendable_list()
+                        parser = ijson.items_coro(found, 'workflow_runs.item', use_float=True)
+                        async for chunk in response.aiter_bytes():
+                            parser.send(chunk)
+                            if found:
+                                break
+                        data = {'workflow_runs': [_slim_run(run) for run in found[:1]]}
+                        if 'ETag' in response.headers:
+                            self.etag_cache[repo] = response.headers['ETag']
+                            self.last_status_cache[repo] = data
+                    elif response.status_code == 304 and repo in self.last_status_cache:
+                        # Unchanged since last check - 304s don't count against the rate limit
+                        data = self.last_status_cache[repo]
+            
+            if rate_limited:
+                # Fall back to the last runs we saw instead of reporting a failure
+                data = self.last_status_cache.get(repo)
+                if data is None:
+                    return {
+                        'healthy': False,
+                        'failure_type': 'rate_limited',
+                        'last_success': None
+                    }
+            
+            if data is not None:
+                return self.assess_runs(data.get('workflow_runs', []), now)
             
             return {
                 'healthy': False,
@@ -101,6 +237,94 @@ class SelfHealingSystem:
                 'last_success': None
             }
     
+    async def query_all_agents_health(self, client, repos, now):
+        """Fetch every agent's latest run in a single GraphQL request"""
+        if self.is_rate_limited():
+            return {}
+        
+        # One aliased repository() lookup per agent, all sharing the same selection
+        aliases = '\n'.join(
+            f'  r{i}: repository(owner: $owner, name: {json.dumps(repo)}) {{ ...latestRun }}'
+            for i, repo in enumerate(repos)
+        )
+        query = f"""query($owner: String!) {{
+{aliases}
+}}
+fragment latestRun on Repository {{
+  defaultBranchRef {{
+    target {{
+      ... on Commit {{
+        checkSuites(last: 10, filterBy: {{appId: 15368}}) {{
+          nodes {{ status conclusion createdAt }}
+        }}
+      }}
+    }}
+  }}
+}}"""
+        
+        try:
+            payload = {'query': query, 'variables': {'owner': self.username}}
+            response = await client.post("https://api.github.com/graphql", json=payload)
+            if self.record_rate_limit(response.status_code, response.headers) or response.status_code != 200:
+                return {}
+            data = orjson.loads(response.content).get('data') or {}
+        except Exception as e:
+            print(f"  ⚠️ GraphQL health query failed: {e}")
+            return {}
+        
+        statuses = {}
+        for i, repo in enumerate(repos):
+            repository = data.get(f'r{i}')
+            if not repository or not repository.get('defaultBranchRef'):
+                continue
+            try:
+                suites = repository['defaultBranchRef']['target'].get('checkSuites', {}).get('nodes', [])
+                completed = [suite for suite in suites if suite['status'] == 'COMPLETED']
+                if not completed:
+                    # HEAD has no finished Actions run (e.g. the agent pushed it with
+                    # GITHUB_TOKEN) - that says nothing about the schedule, so let REST decide
+                    continue
+                latest = completed[-1]
+                statuses[repo] = self.assess_runs(
+                    [{'created_at': latest['createdAt'], 'conclusion': (latest['conclusion'] or '').lower() or None}], now
+                )
+            except (KeyError, TypeError, AttributeError, ValueError):
+                # Unexpected node shape - let REST decide for this repo
+                continue
+        
+        return statuses
+    
+    def assess_runs(self, runs, now):
+        """Derive agent health from its most recent workflow runs"""
+        if not runs:
+            # The agent has never completed a run
+            return {
+                'healthy': False,
+                'failure_type': 'schedule_failure',
+                'last_success': None
+            }
+        
+        latest_run = runs[0]
+        
+        # Check if agent ran recently
+        time_since_run = now - _parse_gh_ts(latest_run['created_at'])
+        
+        if time_since_run > timedelta(hours=8):  # Should run every 6 hours
+            return {
+                'healthy': False,
+                'failure_type': 'schedule_failure',
+                'last_success': latest_run['created_at']
+            }
+        
+        if latest_run.get('conclusion') == 'failure':
+            return {
+                'healthy': False,
+                'failure_type': 'execution_failure',
+                'last_success': None  # Looked up separately by find_last_successful_run
+            }
+        
+        return {'healthy': True}
+    
     def heal_agent(self, failed_agent):
         """Heal a specific failed agent"""
         repo = failed_agent['repo']
@@ -136,24 +360,27 @@ class SelfHealingSystem:
     
     def trigger_manual_run(self, repo):
         """Trigger manual workflow run"""
+        if self.is_rate_limited():
+            print(f"  ⏳ Skipping manual run for {repo} - rate limited")
+            return False
+        
         try:
-            url = f"https://api.github.com/repos/{self.get_username()}/{repo}/actions/workflows"
-            response = requests.get(url, headers=self.headers)
-            
-            if response.status_code == 200:
-                workflows = response.json().get('workflows', [])
-                if workflows:
-                    workflow_id = workflows[0]['id']
-                    
-                    # Trigger workflow dispatch
-                    dispatch_url = f"https://api.github.com/repos/{self.get_username()}/{repo}/actions/workflows/{workflow_id}/dispatches"
-                    dispatch_data = {'ref': 'main'}
-                    
-                    dispatch_response = requests.post(dispatch_url, headers=self.headers, json=dispatch_data)
-                    
-                    if dispatch_response.status_code == 204:
-                        print(f"  ✅ Triggered manual run for {repo}")
-                        return True
+            workflow_id = self._workflow_id_cache.get(repo) or self._discover_workflow(repo)
+            if workflow_id:
+                # Trigger workflow dispatch
+                dispatch_url = self._dispatch_url_tpl.format(repo=repo, workflow_id=workflow_id)
+                dispatch_data = {'ref': 'main'}
+                
+                dispatch_response = self.session.post(dispatch_url, json=dispatch_data)
+                self.record_rate_limit(dispatch_response.status_code, dispatch_response.headers)
+                
+                if dispatch_response.status_code == 204:
+                    print(f"  ✅ Triggered manual run for {repo}")
+                    return True
+                
+                if dispatch_response.status_code == 404:
+                    # Workflow was removed or renamed - rediscover it next time
+                    self._workflow_id_cache.pop(repo, None)
             
             return False
             
@@ -161,6 +388,20 @@ class SelfHealingSystem:
             print(f"  ❌ Failed to trigger run for {repo}: {e}")
             return False
     
+    def _discover_workflow(self, repo):
+        """Look up and cache the ID of the agent's workflow"""
+        url = self._workflows_url_tpl.format(repo=repo)
+        response = self.session.get(url, params={'per_page': 1})
+        self.record_rate_limit(response.status_code, response.headers)
+        
+        if response.status_code == 200:
+            workflows = orjson.loads(response.content).get('workflows', [])
+            if workflows:
+                self._workflow_id_cache[repo] = workflows[0]['id']
+                return workflows[0]['id']
+        
+        return None
+    
     def fix_execution_error(self, repo):
         """Fix execution errors in agent"""
         # Implementation for fixing common execution errors
@@ -177,81 +418,128 @@ class SelfHealingSystem:
     
     def analyze_failures(self, failed_agents):
         """Analyze failure patterns"""
-        analysis = {
+        failure_types = dict(Counter(agent['failure_type'] for agent in failed_agents))
+        
+        return {
             'total_failures': len(failed_agents),
-            'failure_types': {},
-            'patterns': []
+            'failure_types': failure_types,
+            # Identify patterns
+            'patterns': [
+                message for failure_type, threshold, message in PATTERN_RULES
+                if failure_types.get(failure_type, 0) > threshold
+            ]
         }
-        
-        for agent in failed_agents:
-            failure_type = agent['failure_type']
-            analysis['failure_types'][failure_type] = analysis['failure_types'].get(failure_type, 0) + 1
-        
-        # Identify patterns
-        if analysis['failure_types'].get('schedule_failure', 0) > 3:
-            analysis['patterns'].append('Multiple schedule failures - check GitHub Actions limits')
-        
-        if analysis['failure_types'].get('execution_failure', 0) > 2:
-            analysis['patterns'].append('Multiple execution failures - check code quality')
-        
-        return analysis
     
     def update_healing_strategies(self, analysis):
         """Update healing strategies based on failure analysis"""
         # AI-powered strategy updates would go here
         pass
     
-    def load_healing_strategies(self):
-        """Load healing strategies"""
-        return {
-            'schedule_failure': {
-                'name': 'Schedule Recovery',
-                'action': 'trigger_manual_run',
-                'success_rate': 85
-            },
-            'execution_failure': {
-                'name': 'Execution Recovery',
-                'action': 'fix_execution_error',
-                'success_rate': 70
-            },
-            'api_error': {
-                'name': 'API Recovery',
-                'action': 'fix_api_issue',
-                'success_rate': 60
-            },
-            'default': {
-                'name': 'Default Recovery',
-                'action': 'apply_default_healing',
-                'success_rate': 50
-            }
-        }
+    async def find_last_successful_run(self, client, repo):
+        """Find last successful run"""
+        if self.is_rate_limited():
+            return None
+        
+        url = self._runs_url_tpl.format(repo=repo)
+        response = await client.get(url, params={'status': 'success', 'per_page': 1})
+        if self.record_rate_limit(response.status_code, response.headers) or response.status_code != 200:
+            return None
+        runs = orjson.loads(response.content).get('workflow_runs', [])
+        
+        return runs[0]['created_at'] if runs else None
     
-    def get_all_agent_repos(self):
-        """Get list of all agent repositories"""
-        return [
-            'github-arbitrage-agent', 'ai-wrapper-factory', 'saas-template-mill',
-            'automation-broker', 'crypto-degen-bot', 'influencer-farm',
-            'course-generator', 'patent-scraper', 'domain-flipper'
-        ]
+    def load_health_cache(self):
+        """Load ETags, cached runs and workflow IDs saved by a previous invocation"""
+        try:
+            with open(HEALTH_CACHE_PATH) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(cache, dict):
+            return
+        
+        for repo, entry in cache.items():
+            # Skip malformed entries rather than refuse to start
+            if not isinstance(entry, dict):
+                continue
+            if isinstance(entry.get('etag'), str) and isinstance(entry.get('status'), dict):
+                try:
+                    runs = [_slim_run(run) for run in entry['status'].get('workflow_runs', [])]
+                except (KeyError, TypeError, AttributeError):
+                    continue
+                self.etag_cache[repo] = entry['etag']
+                self.last_status_cache[repo] = {'workflow_runs': runs}
+            if isinstance(entry.get('workflow_id'), int):
+                self._workflow_id_cache[repo] = entry['workflow_id']
     
-    def find_last_successful_run(self, runs):
-        """Find last successful run"""
-        for run in runs:
-            if run.get('conclusion') == 'success':
-                return run['created_at']
-        return None
+    def save_health_cache(self):
+        """Persist ETags, cached runs and workflow IDs for the next invocation"""
+        cache = {}
+        for repo, etag in self.etag_cache.items():
+            if repo in self.last_status_cache:
+                cache[repo] = {'etag': etag, 'status': self.last_status_cache[repo]}
+        for repo, workflow_id in self._workflow_id_cache.items():
+            cache.setdefault(repo, {})['workflow_id'] = workflow_id
+        try:
+            with open(HEALTH_CACHE_PATH, 'w') as f:
+                json.dump(cache, f)
+        except OSError as e:
+            print(f"  ⚠️ Could not save health cache: {e}")
+    
+    def is_rate_limited(self):
+        """Whether API calls are paused after hitting a rate limit"""
+        return time.monotonic() < self._rate_limited_until
+    
+    def record_rate_limit(self, status_code, headers):
+        """Pause API calls if a response signals rate limiting"""
+        is_rate_limit = status_code == 429 or (
+            status_code == 403 and ('Retry-After' in headers or headers.get('X-RateLimit-Remaining') == '0')
+        )
+        # Heal threads share the backoff state
+        with self._rate_limit_lock:
+            if not is_rate_limit:
+                # Responses to requests sent before the pause don't prove the limit has lifted
+                if not self.is_rate_limited():
+                    self._rate_limit_failures = 0
+                return False
+            
+            # A burst of in-flight requests rejected together is one failure, not many
+            already_paused = self.is_rate_limited()
+            if not already_paused:
+                self._rate_limit_failures += 1
+            
+            # Exponential backoff: 2s, 4s, 8s ... capped at 5 minutes
+            wait = min(2 ** self._rate_limit_failures, 300)
+            
+            # Honour GitHub's own hint when it gives one
+            if 'Retry-After' in headers:
+                wait = max(wait, float(headers['Retry-After']))
+            elif 'X-RateLimit-Reset' in headers:
+                wait = max(wait, float(headers['X-RateLimit-Reset']) - time.time())
+            
+            self._rate_limited_until = max(self._rate_limited_until, time.monotonic() + wait)
+        
+        if not already_paused:
+            print(f"  ⏳ Rate limited (HTTP {status_code}) - pausing API calls for {wait:.0f}s")
+        return True
     
-    def get_username(self):
-        """Get GitHub username"""
+    @cached_property
+    def username(self):
+        """GitHub username, fetched once per process"""
+        # Actions' GITHUB_TOKEN is an installation token and gets 403 from /user,
+        # but the runner tells us whose repos we're in
+        owner = os.getenv('GITHUB_REPOSITORY_OWNER')
         try:
-            response = requests.get("https://api.github.com/user", headers=self.headers)
+            response = self.session.get("https://api.github.com/user")
+            self.record_rate_limit(response.status_code, response.headers)
             if response.status_code == 200:
-                return response.json()['login']
-        except:
-            pass
-        return 'unknown'
+                return orjson.loads(response.content)['login']
+            if not owner:
+                print(f"  ⚠️ GitHub user lookup failed: HTTP {response.status_code}")
+        except (requests.RequestException, KeyError, ValueError) as e:
+            print(f"  ⚠️ GitHub user lookup failed: {e}")
+        return owner or None
 
 if __name__ == "__main__":
-    import os
     healer = SelfHealingSystem(os.getenv('GITHUB_TOKEN'))
     healer.monitor_and_heal()